@@ -1,14 +1,28 @@
 # dags/embedding_update_dag.py
 
 from datetime import datetime, timedelta
+from typing import List
 import os
+import sys
 
 from airflow import DAG
+from airflow.decorators import task
 from airflow.operators.bash import BashOperator
 
 PROJECT_ROOT = os.environ.get("RAG_PROJECT_ROOT", "/opt/airflow")
 PYTHON_BIN = os.environ.get("RAG_PYTHON_BIN", "python")
 
+# src パッケージを TaskFlow タスクから import できるようにする
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+# ==== プール設定 ====
+# 事前に作成しておく:
+#   airflow pools set diet_api_pool 4 "国会議事録API（レート制限考慮）"
+#   airflow pools set embed_pool 1 "埋め込み計算"（DB全体を再構築するため同時実行は1つ）
+DIET_API_POOL = "diet_api_pool"
+EMBED_POOL = "embed_pool"
+
 # ==== DAG の共通設定 ====
 
 default_args = {
@@ -25,26 +39,62 @@ with DAG(
     start_date=datetime(2025, 1, 1),
     schedule_interval="8 2 * * *",  # 毎日 03:00 (UTC)
     catchup=False,
+    max_active_runs=1,  # 手動実行と定期実行が重なってシャード・DBを同時に書かないようにする
     tags=["rag", "diet", "chroma"],
 ) as dag:
 
-    # 1. 国会議事録の最新JSONLを取得するタスク
-    fetch_diet_speeches = BashOperator(
-        task_id="fetch_diet_speeches",
-        bash_command=(
-            f"cd {PROJECT_ROOT} && "
-            f"PYTHONUNBUFFERED=1 {PYTHON_BIN} src/get_diet_speeches.py"
-        ),
-    )
+    # 1. 取得期間を月単位のシャードに分割するタスク
+    @task
+    def generate_monthly_ranges() -> List[List[str]]:
+        from datetime import date
+
+        from src.get_diet_speeches import (
+            generate_monthly_ranges as _generate_monthly_ranges,
+            get_fetch_start_date,
+        )
+
+        return [list(r) for r in _generate_monthly_ranges(get_fetch_start_date(), date.today())]
+
+    # 2. シャードごとに国会議事録を並列取得するタスク
+    @task(pool=DIET_API_POOL)
+    def fetch_shard(date_range: List[str]) -> str:
+        import asyncio
+        from datetime import date
+
+        from src.get_diet_speeches import SHARD_DIR, fetch_shard as _fetch_shard
+
+        from_str, until_str = date_range
+        out_path = SHARD_DIR / f"{from_str}_{until_str}.jsonl"
+        # シャード間の並列度はプールで制御するため、シャード内は逐次取得
+        asyncio.run(
+            _fetch_shard(
+                date.fromisoformat(from_str),
+                date.fromisoformat(until_str),
+                out_path,
+                concurrency=1,
+            )
+        )
+        return str(out_path)
+
+    # 3. シャードJSONLを重複除去して本体JSONLへ統合するタスク
+    @task
+    def merge_shards(shard_paths: List[str]) -> None:
+        from pathlib import Path
+
+        from src.get_diet_speeches import merge_shards as _merge_shards
+
+        _merge_shards([Path(p) for p in shard_paths])
 
-    # 2. JSONL → ベクトルDB更新（update_vectorstore.py）
+    # 4. JSONL → ベクトルDB更新（update_vectorstore.py）
     update_vectorstore = BashOperator(
         task_id="update_vectorstore",
         bash_command=(
             f"cd {PROJECT_ROOT} && "
-            f"PYTHONUNBUFFERED=1 {PYTHON_BIN} src/update_vectorstore.py"
+            f"PYTHONUNBUFFERED=1 {PYTHON_BIN} -m src.update_vectorstore"
         ),
+        pool=EMBED_POOL,
     )
 
-    # 実行順序: get_diet_speeches → update_vectorstore
-    fetch_diet_speeches >> update_vectorstore
+    # 実行順序: シャード分割 → 並列取得 → 統合 → update_vectorstore
+    shard_paths = fetch_shard.expand(date_range=generate_monthly_ranges())
+    merge_shards(shard_paths) >> update_vectorstore
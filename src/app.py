@@ -1,23 +1,44 @@
 # src/app.py
 """FastAPI による RAG API サーバー"""
 
-from typing import List, Dict, Any
-
+import os
+import sys
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import List, Dict, Any, AsyncIterator, Optional, Tuple
+
+import anyio
+from cachetools import TTLCache
 from fastapi import FastAPI
 from pydantic import BaseModel, Field
 
-from src.rag_engine import answer_question
+from src.rag_engine import answer_question, get_db_version
 
 # ===== 定数 =====
 DEFAULT_TOP_K = 10
 SERVER_HOST = "0.0.0.0"
 SERVER_PORT = 8000
+WORKERS = int(os.getenv("WEB_CONCURRENCY", "1"))  # ワーカープロセス数
+THREADPOOL_TOKENS = 100  # ブロッキング処理用スレッドプールの上限（既定値は40）
+RESPONSE_CACHE_SIZE = 1024
+RESPONSE_CACHE_TTL = 300  # 回答キャッシュの有効期間（秒）
+
+
+# ===== ライフサイクル =====
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """起動時にスレッドプールの上限を引き上げる"""
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    limiter.total_tokens = THREADPOOL_TOKENS
+    yield
+
 
 # ===== FastAPI アプリ =====
 app = FastAPI(
     title="国会発言検索 RAG API",
     description="高市早苗氏の国会発言をベクトル検索するAPI",
     version="1.0.0",
+    lifespan=lifespan,
 )
 
 
@@ -26,7 +47,10 @@ class AskRequest(BaseModel):
     """質問リクエスト"""
     question: str = Field(..., description="検索クエリ", example="安全保障について")
     top_k: int = Field(default=DEFAULT_TOP_K, description="検索する文書数", ge=1, le=50)
-    session_id: str = Field(default="default", description="セッションID")
+    session_id: Optional[str] = Field(
+        default=None,
+        description="セッションID（未指定なら会話履歴なしで回答し、結果をキャッシュ）",
+    )
 
 
 class ContextDoc(BaseModel):
@@ -41,6 +65,16 @@ class AskResponse(BaseModel):
     context_docs: List[ContextDoc] = Field(..., description="参照した文書リスト")
 
 
+# ===== 回答キャッシュ =====
+# 履歴なし（session_id 未指定）の回答のみ対象。イベントループ上でのみ読み書きするためロック不要
+_response_cache: TTLCache = TTLCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+
+
+def _cache_key(req: AskRequest) -> Tuple[str, int, str]:
+    """回答キャッシュのキー（稼働中のベクトルDBが入れ替われば別キーになる）"""
+    return (req.question, req.top_k, get_db_version())
+
+
 # ===== エンドポイント =====
 @app.get("/health")
 def health_check() -> Dict[str, str]:
@@ -49,7 +83,7 @@ def health_check() -> Dict[str, str]:
 
 
 @app.post("/ask", response_model=AskResponse)
-def ask(req: AskRequest) -> AskResponse:
+async def ask(req: AskRequest) -> AskResponse:
     """
     高市早苗氏の国会発言を検索
     
@@ -60,11 +94,21 @@ def ask(req: AskRequest) -> AskResponse:
       -d '{"question": "安全保障に関する発言を教えて", "top_k": 3}'
 ```
     """
-    result = answer_question(
-        question=req.question,
-        top_k=req.top_k,
-        session_id=req.session_id,
-    )
+    cache_key = _cache_key(req) if req.session_id is None else None
+    result = _response_cache.get(cache_key) if cache_key else None
+    
+    if result is None:
+        # LLM・ベクトルDB呼び出しはブロッキングのためスレッドプールへ逃がす
+        result = await anyio.to_thread.run_sync(
+            partial(
+                answer_question,
+                question=req.question,
+                top_k=req.top_k,
+                session_id=req.session_id,
+            )
+        )
+        if cache_key:
+            _response_cache[cache_key] = result
     
     # context_docs を ContextDoc 形式に変換
     context_docs = [
@@ -80,4 +124,12 @@ def ask(req: AskRequest) -> AskResponse:
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("src.app:app", host=SERVER_HOST, port=SERVER_PORT, reload=True)
\ No newline at end of file
+    # uvloop は Windows 非対応のため asyncio にフォールバック
+    uvicorn.run(
+        "src.app:app",
+        host=SERVER_HOST,
+        port=SERVER_PORT,
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        workers=WORKERS,
+    )
\ No newline at end of file
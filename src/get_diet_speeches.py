@@ -1,13 +1,14 @@
 # src/get_diet_speeches.py
 """国会議事録APIからデータを取得するスクリプト"""
 
-import requests
-import time
-import json
+import asyncio
+import orjson
 from pathlib import Path
-import math
+import sqlite3
 from datetime import date, timedelta
-from typing import Optional, Set
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import httpx
 
 # ===== 設定 =====
 BASE_URL = "https://kokkai.ndl.go.jp/api/speech"
@@ -18,50 +19,84 @@ OUT_DIR.mkdir(parents=True, exist_ok=True)
 
 OUT_PATH = OUT_DIR / "diet_speeches.jsonl"
 STATE_PATH = OUT_DIR / "fetch_state.json"
-IDS_PATH = OUT_DIR / "fetched_ids.txt"
+IDS_DB = OUT_DIR / "fetched_ids.sqlite"
+LEGACY_IDS_PATH = OUT_DIR / "fetched_ids.txt"  # 旧形式（SQLite移行前）
+SHARD_DIR = OUT_DIR / "shards"
 
 INIT_FROM_DATE = date(2023, 1, 1)
 REQUEST_INTERVAL = 1  # APIリクエスト間隔（秒）
 MAX_RECORDS_PER_REQUEST = 100
+WRITE_BUFFER_SIZE = 1 << 20  # JSONL書き込みバッファ（1MB）
+
+API_CONCURRENCY = 3  # 同時リクエスト数（APIへの配慮として少数に留める）
+RETRY_TOTAL = 3
+RETRY_BACKOFF = 0.5  # 再試行の待ち時間の基数（秒）
+RETRY_STATUSES = {429, 500, 502, 503, 504}
 
 
 def load_state() -> dict:
     """取得状態を読み込む"""
     if STATE_PATH.exists():
-        with STATE_PATH.open("r", encoding="utf-8") as f:
-            return json.load(f)
+        return orjson.loads(STATE_PATH.read_bytes())
     return {"last_fetched_date": None}
 
 
 def save_state(last_date: str) -> None:
     """取得状態を保存"""
-    with STATE_PATH.open("w", encoding="utf-8") as f:
-        json.dump({"last_fetched_date": last_date}, f, ensure_ascii=False)
+    STATE_PATH.write_bytes(orjson.dumps({"last_fetched_date": last_date}))
+
+
+def open_ids_db() -> sqlite3.Connection:
+    """取得済みID管理用のSQLite DBを開く（なければ作成）"""
+    conn = sqlite3.connect(IDS_DB)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS ids(speech_id TEXT PRIMARY KEY) WITHOUT ROWID"
+    )
+    
+    # 旧形式のIDファイルがあれば、空のテーブルへ一括取り込み
+    if LEGACY_IDS_PATH.exists() and conn.execute("SELECT 1 FROM ids LIMIT 1").fetchone() is None:
+        with LEGACY_IDS_PATH.open("r", encoding="utf-8") as f, conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO ids(speech_id) VALUES (?)",
+                ((line.strip(),) for line in f if line.strip()),
+            )
+        # 再取り込みしないよう退避
+        LEGACY_IDS_PATH.replace(LEGACY_IDS_PATH.with_suffix(".txt.migrated"))
+    return conn
+
 
+def mark_fetched(conn: sqlite3.Connection, speech_id: str) -> bool:
+    """IDを取得済みとして登録（新規ならTrue、登録済みならFalse）"""
+    cur = conn.execute("INSERT OR IGNORE INTO ids(speech_id) VALUES (?)", (speech_id,))
+    return cur.rowcount == 1
 
-def load_fetched_ids() -> Set[str]:
-    """取得済みIDを読み込む"""
-    if not IDS_PATH.exists():
-        return set()
-    with IDS_PATH.open("r", encoding="utf-8") as f:
-        return set(line.strip() for line in f if line.strip())
 
+def build_client() -> httpx.AsyncClient:
+    """keep-alive（gzip は httpx 既定）の非同期クライアントを生成
 
-def save_fetched_ids(ids: Set[str]) -> None:
-    """取得済みIDを保存"""
-    with IDS_PATH.open("w", encoding="utf-8") as f:
-        for id_ in ids:
-            f.write(id_ + "\n")
+    同時リクエストは数本のため HTTP/1.1 で十分（h2 パッケージに依存しない）。
+    """
+    transport = httpx.AsyncHTTPTransport(
+        retries=RETRY_TOTAL,
+        limits=httpx.Limits(max_connections=API_CONCURRENCY + 1),
+    )
+    return httpx.AsyncClient(transport=transport, timeout=60.0)
 
 
-def append_fetched_ids(new_ids: Set[str]) -> None:
-    """取得済みIDを追記"""
-    with IDS_PATH.open("a", encoding="utf-8") as f:
-        for id_ in new_ids:
-            f.write(id_ + "\n")
+async def api_get(client: httpx.AsyncClient, params: Dict[str, Any]) -> Dict[str, Any]:
+    """APIを呼び出してJSONを返す（429/5xx は指数バックオフで再試行）"""
+    for attempt in range(RETRY_TOTAL + 1):
+        r = await client.get(BASE_URL, params=params)
+        if r.status_code not in RETRY_STATUSES or attempt == RETRY_TOTAL:
+            break
+        await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
+    r.raise_for_status()
+    return orjson.loads(r.content)
 
 
-def get_record_count(from_str: str, until_str: str) -> int:
+async def get_record_count(client: httpx.AsyncClient, from_str: str, until_str: str) -> int:
     """指定期間のレコード件数を取得"""
     params = {
         "from": from_str,
@@ -70,12 +105,70 @@ def get_record_count(from_str: str, until_str: str) -> int:
         "maximumRecords": 1,
         "recordPacking": "json",
     }
-    r = requests.get(BASE_URL, params=params)
-    r.raise_for_status()
-    return int(r.json().get("numberOfRecords", 0))
+    data = await api_get(client, params)
+    return int(data.get("numberOfRecords", 0))
 
 
-def fetch_initial(from_date: date, to_date: date) -> Optional[str]:
+async def fetch_pages(
+    client: httpx.AsyncClient,
+    params: Dict[str, Any],
+    total: int,
+    on_page: Callable[[int, List[Dict[str, Any]]], None],
+    concurrency: int = API_CONCURRENCY,
+) -> None:
+    """
+    全ページを並行取得し、1つのライターでページ順に on_page へ渡す
+    （ファイル追記・ID登録はライターのみが行うため競合しない）
+    """
+    starts = range(1, total + 1, MAX_RECORDS_PER_REQUEST)
+    queue: asyncio.Queue = asyncio.Queue()
+    sem = asyncio.Semaphore(concurrency)
+    failed = asyncio.Event()
+
+    async def fetch_page(start_record: int) -> None:
+        try:
+            async with sem:
+                data = await api_get(client, {**params, "startRecord": start_record})
+        except Exception:
+            failed.set()
+            raise
+        speech_records = data.get("speechRecord", [])
+        if isinstance(speech_records, dict):
+            speech_records = [speech_records]
+        await queue.put((start_record, speech_records))
+
+    async def writer() -> None:
+        # 完了順に届くページを start_record 順に並べ直して書き込む
+        buffered: Dict[int, List[Dict[str, Any]]] = {}
+        next_index = 0
+        while (item := await queue.get()) is not None:
+            buffered[item[0]] = item[1]
+            while next_index < len(starts) and starts[next_index] in buffered:
+                start_record = starts[next_index]
+                on_page(start_record, buffered.pop(start_record))
+                next_index += 1
+
+    writer_task = asyncio.create_task(writer())
+    tasks: List[asyncio.Task] = []
+    try:
+        for start_record in starts:
+            # 取得・書き込みに失敗したら残りのページは投入しない
+            if failed.is_set() or writer_task.done():
+                break
+            tasks.append(asyncio.create_task(fetch_page(start_record)))
+            # 投入間隔を空けて平均 concurrency / REQUEST_INTERVAL 件/秒に抑える
+            await asyncio.sleep(REQUEST_INTERVAL / concurrency)
+        await asyncio.gather(*tasks)
+    finally:
+        # 失敗時に残ったリクエストを取り消してから終了する
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await queue.put(None)
+        await writer_task
+
+
+async def fetch_initial(from_date: date, to_date: date) -> Optional[str]:
     """
     初回取得: メモリに溜めずに直接JSONLへストリーム書き込み
     
@@ -85,137 +178,232 @@ def fetch_initial(from_date: date, to_date: date) -> Optional[str]:
     from_str = from_date.isoformat()
     until_str = to_date.isoformat()
     
-    print(f"件数確認中... {from_str} 〜 {until_str}")
-    total = get_record_count(from_str, until_str)
-    print(f"検索結果件数: {total}")
-    
-    if total == 0:
-        print("データなし。")
-        return None
+    async with build_client() as client:
+        print(f"件数確認中... {from_str} 〜 {until_str}")
+        total = await get_record_count(client, from_str, until_str)
+        print(f"検索結果件数: {total}")
+        
+        if total == 0:
+            print("データなし。")
+            return None
+        
+        params = {
+            "from": from_str,
+            "until": until_str,
+            "nameOfMeeting": "本会議 予算委員会 総務委員会",
+            "maximumRecords": MAX_RECORDS_PER_REQUEST,
+            "recordPacking": "json",
+        }
+        
+        fetched = 0
+        latest_date = None
+        conn = open_ids_db()
+        with conn:
+            conn.execute("DELETE FROM ids")
+        
+        with OUT_PATH.open("wb", buffering=WRITE_BUFFER_SIZE) as f_out:
+            def on_page(start_record: int, speech_records: List[Dict[str, Any]]) -> None:
+                nonlocal fetched, latest_date
+                
+                # ページ単位で1トランザクションにまとめてID登録
+                with conn:
+                    for rec in speech_records:
+                        f_out.write(orjson.dumps(rec) + b"\n")
+                        fetched += 1
+                        
+                        speech_id = rec.get("speechID")
+                        if speech_id:
+                            mark_fetched(conn, speech_id)
+                        
+                        rec_date = rec.get("date")
+                        if rec_date and (latest_date is None or rec_date > latest_date):
+                            latest_date = rec_date
+                
+                print(f"\r取得中... {fetched}/{total}", end="", flush=True)
+            
+            await fetch_pages(client, params, total, on_page)
+        
+        conn.close()
     
-    params = {
-        "from": from_str,
-        "until": until_str,
-        "nameOfMeeting": "本会議 予算委員会 総務委員会",
-        "maximumRecords": MAX_RECORDS_PER_REQUEST,
-        "recordPacking": "json",
-    }
+    print(f"\n✅ 初回取得完了: {fetched}件")
+    return latest_date
+
+
+async def fetch_incremental(from_date: date, to_date: date) -> Optional[str]:
+    """
+    差分取得: 取得済みID DBでチェックして重複を避ける
     
-    pages = math.ceil(total / MAX_RECORDS_PER_REQUEST)
-    fetched = 0
-    latest_date = None
-    all_ids: Set[str] = set()
+    Returns:
+        取得した最新日付（新規データがなければNone）
+    """
+    from_str = from_date.isoformat()
+    until_str = to_date.isoformat()
     
-    with OUT_PATH.open("w", encoding="utf-8") as f_out:
-        for i in range(pages):
-            start_record = 1 + i * MAX_RECORDS_PER_REQUEST
-            if start_record > total:
-                break
-            
-            params["startRecord"] = start_record
-            r = requests.get(BASE_URL, params=params)
-            r.raise_for_status()
-            data = r.json()
-            
-            speech_records = data.get("speechRecord", [])
-            if isinstance(speech_records, dict):
-                speech_records = [speech_records]
-            
-            for rec in speech_records:
-                f_out.write(json.dumps(rec, ensure_ascii=False) + "\n")
-                fetched += 1
+    async with build_client() as client:
+        print(f"件数確認中... {from_str} 〜 {until_str}")
+        total = await get_record_count(client, from_str, until_str)
+        print(f"検索結果件数: {total}")
+        
+        if total == 0:
+            print("新規データなし。")
+            return None
+        
+        params = {
+            "from": from_str,
+            "until": until_str,
+            "nameOfMeeting": "本会議 予算委員会 総務委員会",
+            "maximumRecords": MAX_RECORDS_PER_REQUEST,
+            "recordPacking": "json",
+        }
+        
+        new_count = 0
+        latest_date = None
+        conn = open_ids_db()
+        
+        with OUT_PATH.open("ab", buffering=WRITE_BUFFER_SIZE) as f_out:
+            def on_page(start_record: int, speech_records: List[Dict[str, Any]]) -> None:
+                nonlocal new_count, latest_date
                 
-                speech_id = rec.get("speechID")
-                if speech_id:
-                    all_ids.add(speech_id)
+                # ページ単位で1トランザクションにまとめてID登録
+                with conn:
+                    for rec in speech_records:
+                        speech_id = rec.get("speechID")
+                        
+                        # 重複スキップ
+                        if speech_id and not mark_fetched(conn, speech_id):
+                            continue
+                        
+                        f_out.write(orjson.dumps(rec) + b"\n")
+                        new_count += 1
+                        
+                        rec_date = rec.get("date")
+                        if rec_date and (latest_date is None or rec_date > latest_date):
+                            latest_date = rec_date
                 
-                rec_date = rec.get("date")
-                if rec_date and (latest_date is None or rec_date > latest_date):
-                    latest_date = rec_date
+                print(f"\r取得中... {start_record}/{total} (新規: {new_count}件)", end="", flush=True)
             
-            print(f"\r取得中... {fetched}/{total}", end="", flush=True)
-            time.sleep(REQUEST_INTERVAL)
-    
-    save_fetched_ids(all_ids)
+            await fetch_pages(client, params, total, on_page)
+        
+        conn.close()
     
-    print(f"\n✅ 初回取得完了: {fetched}件")
+    print(f"\n✅ 差分取得完了: {new_count}件追加")
     return latest_date
 
 
-def fetch_incremental(from_date: date, to_date: date) -> Optional[str]:
+def get_fetch_start_date() -> date:
+    """取得開始日を決定（初回は INIT_FROM_DATE、以降は前回最新日の3日前）"""
+    state = load_state()
+    if OUT_PATH.exists() and OUT_PATH.stat().st_size > 0 and state["last_fetched_date"]:
+        return date.fromisoformat(state["last_fetched_date"]) - timedelta(days=3)
+    return INIT_FROM_DATE
+
+
+def generate_monthly_ranges(from_date: date, to_date: date) -> List[Tuple[str, str]]:
+    """期間を月単位に分割した (from, until) のリストを返す"""
+    ranges: List[Tuple[str, str]] = []
+    start = from_date
+    while start <= to_date:
+        next_month = (start.replace(day=1) + timedelta(days=32)).replace(day=1)
+        end = min(next_month - timedelta(days=1), to_date)
+        ranges.append((start.isoformat(), end.isoformat()))
+        start = next_month
+    return ranges
+
+
+async def fetch_shard(
+    from_date: date,
+    to_date: date,
+    out_path: Path,
+    concurrency: int = API_CONCURRENCY,
+) -> int:
     """
-    差分取得: IDファイルでチェックして重複を避ける
+    シャード取得: 指定期間の発言を重複チェックせずにシャードJSONLへ書き込む
+    （並列実行用。重複除去は merge_shards で行う）
     
     Returns:
-        取得した最新日付（新規データがなければNone）
+        書き込んだ件数
     """
     from_str = from_date.isoformat()
     until_str = to_date.isoformat()
     
-    existing_ids = load_fetched_ids()
-    print(f"重複チェック用ID数: {len(existing_ids)}")
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    fetched = 0
     
-    print(f"件数確認中... {from_str} 〜 {until_str}")
-    total = get_record_count(from_str, until_str)
-    print(f"検索結果件数: {total}")
+    async with build_client() as client:
+        total = await get_record_count(client, from_str, until_str)
+        print(f"[{from_str} 〜 {until_str}] 検索結果件数: {total}")
+        
+        params = {
+            "from": from_str,
+            "until": until_str,
+            "nameOfMeeting": "本会議 予算委員会 総務委員会",
+            "maximumRecords": MAX_RECORDS_PER_REQUEST,
+            "recordPacking": "json",
+        }
+        
+        with out_path.open("wb", buffering=WRITE_BUFFER_SIZE) as f_out:
+            def on_page(start_record: int, speech_records: List[Dict[str, Any]]) -> None:
+                nonlocal fetched
+                for rec in speech_records:
+                    f_out.write(orjson.dumps(rec) + b"\n")
+                    fetched += 1
+            
+            await fetch_pages(client, params, total, on_page, concurrency=concurrency)
     
-    if total == 0:
-        print("新規データなし。")
-        return None
+    print(f"[{from_str} 〜 {until_str}] ✅ {fetched}件")
+    return fetched
+
+
+def merge_shards(shard_paths: List[Path]) -> Optional[str]:
+    """
+    シャードJSONLを重複除去しながら本体JSONLへ追記し、取得状態を保存
     
-    params = {
-        "from": from_str,
-        "until": until_str,
-        "nameOfMeeting": "本会議 予算委員会 総務委員会",
-        "maximumRecords": MAX_RECORDS_PER_REQUEST,
-        "recordPacking": "json",
-    }
+    シャードは統合と状態保存が全て成功してから削除する（途中で失敗しても再実行できる）。
     
-    pages = math.ceil(total / MAX_RECORDS_PER_REQUEST)
+    Returns:
+        取得した最新日付（新規データがなければNone）
+    """
+    is_initial = not OUT_PATH.exists() or OUT_PATH.stat().st_size == 0
+    conn = open_ids_db()
+    if is_initial:
+        with conn:
+            conn.execute("DELETE FROM ids")
     new_count = 0
     latest_date = None
-    new_ids: Set[str] = set()
     
-    with OUT_PATH.open("a", encoding="utf-8") as f_out:
-        for i in range(pages):
-            start_record = 1 + i * MAX_RECORDS_PER_REQUEST
-            if start_record > total:
-                break
-            
-            params["startRecord"] = start_record
-            r = requests.get(BASE_URL, params=params)
-            r.raise_for_status()
-            data = r.json()
-            
-            speech_records = data.get("speechRecord", [])
-            if isinstance(speech_records, dict):
-                speech_records = [speech_records]
-            
-            for rec in speech_records:
-                speech_id = rec.get("speechID")
-                
-                # 重複スキップ
-                if speech_id and speech_id in existing_ids:
-                    continue
-                
-                f_out.write(json.dumps(rec, ensure_ascii=False) + "\n")
-                new_count += 1
-                
-                if speech_id:
-                    existing_ids.add(speech_id)
-                    new_ids.add(speech_id)
-                
-                rec_date = rec.get("date")
-                if rec_date and (latest_date is None or rec_date > latest_date):
-                    latest_date = rec_date
-            
-            print(f"\r取得中... {start_record}/{total} (新規: {new_count}件)", end="", flush=True)
-            time.sleep(REQUEST_INTERVAL)
+    with OUT_PATH.open("wb" if is_initial else "ab", buffering=WRITE_BUFFER_SIZE) as f_out:
+        for shard_path in sorted(shard_paths):
+            if not shard_path.exists():
+                print(f"⚠️ シャードが見つからないためスキップ: {shard_path}")
+                continue
+            # シャード単位で1トランザクションにまとめてID登録
+            with shard_path.open("rb") as f_in, conn:
+                for line in f_in:
+                    if not line.strip():
+                        continue
+                    rec = orjson.loads(line)
+                    speech_id = rec.get("speechID")
+                    
+                    # 重複スキップ
+                    if speech_id and not mark_fetched(conn, speech_id):
+                        continue
+                    
+                    f_out.write(line if line.endswith(b"\n") else line + b"\n")
+                    new_count += 1
+                    
+                    rec_date = rec.get("date")
+                    if rec_date and (latest_date is None or rec_date > latest_date):
+                        latest_date = rec_date
     
-    if new_ids:
-        append_fetched_ids(new_ids)
+    conn.close()
     
-    print(f"\n✅ 差分取得完了: {new_count}件追加")
+    if latest_date:
+        save_state(latest_date)
+    
+    for shard_path in shard_paths:
+        shard_path.unlink(missing_ok=True)
+    
+    print(f"✅ シャード統合完了: {new_count}件追加")
     return latest_date
 
 
@@ -226,19 +414,13 @@ def auto_fetch() -> None:
     - JSONLあり → 差分取得
     """
     today = date.today()
-    state = load_state()
     
     if not OUT_PATH.exists() or OUT_PATH.stat().st_size == 0:
         print("=== 初回取得モード ===")
-        latest = fetch_initial(INIT_FROM_DATE, today)
+        latest = asyncio.run(fetch_initial(INIT_FROM_DATE, today))
     else:
         print("=== 差分取得モード ===")
-        if state["last_fetched_date"]:
-            from_date = date.fromisoformat(state["last_fetched_date"]) - timedelta(days=3)
-        else:
-            from_date = INIT_FROM_DATE
-        
-        latest = fetch_incremental(from_date, today)
+        latest = asyncio.run(fetch_incremental(get_fetch_start_date(), today))
     
     if latest:
         save_state(latest)
@@ -1,17 +1,35 @@
 # src/rag_engine.py
 """RAG検索エンジン：ベクトルDBから関連文書を取得してLLMで回答生成"""
 
-from typing import Dict, Optional, Tuple
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 import logging
+import os
+import threading
 
+import httpx
 from langchain_openai import ChatOpenAI
 from langchain_chroma import Chroma
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.output_parsers import StrOutputParser
-from langchain_community.chat_message_histories import ChatMessageHistory
+from langchain_community.chat_message_histories import (
+    ChatMessageHistory,
+    RedisChatMessageHistory,
+)
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.runnables import Runnable
 from langchain_core.runnables.history import RunnableWithMessageHistory
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 
-from src.utils import PERSIST_DIR, COLLECTION_NAME, get_embeddings, format_docs
+from src.utils import (
+    PERSIST_DIR,
+    COLLECTION_NAME,
+    get_embeddings,
+    format_and_extract,
+    migrate_legacy_db,
+    normalize_speaker,
+)
 
 # ===== ロガー設定 =====
 logging.basicConfig(level=logging.INFO)
@@ -22,6 +40,16 @@ DEFAULT_MODEL = "gpt-4o-mini"
 DEFAULT_TEMPERATURE = 0.2
 DEFAULT_TOP_K = 3
 DEFAULT_SPEAKER = "高市早苗"
+SPEAKER_NORM = normalize_speaker(DEFAULT_SPEAKER)
+REDIS_URL = os.getenv("REDIS_URL")  # 未設定ならプロセス内メモリで履歴を保持（開発用）
+HISTORY_TTL = 3600  # 会話履歴の保持期間（秒）
+
+# OpenAI への接続を使い回す共有HTTPクライアント（HTTP/2 + keep-alive）
+_openai_http_client = httpx.Client(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=40),
+    timeout=60.0,
+)
 
 SYSTEM_PROMPT = """あなたは有能なアシスタントです。
 
@@ -35,57 +63,112 @@ SYSTEM_PROMPT = """あなたは有能なアシスタントです。
 """
 
 
-def load_vectorstore() -> Chroma:
+def load_vectorstore(embeddings: Optional[Embeddings] = None) -> Chroma:
     """既存の Chroma ベクトルDB を読み込む
     
+    Args:
+        embeddings: 使い回す埋め込みモデル（未指定なら新たに読み込む）
+        
     Returns:
         Chroma: ベクトルストアインスタンス
         
     Raises:
         RuntimeError: ベクトルDBが見つからない場合
     """
+    migrate_legacy_db()
     if not PERSIST_DIR.exists():
         raise RuntimeError(f"ベクトルDBが見つかりません: {PERSIST_DIR}")
     
-    embeddings = get_embeddings()
+    # リンクを解決した実スロットを開く（入れ替えは refresh_vectorstore で検知する）
+    persist_dir = PERSIST_DIR.resolve()
+    if embeddings is None:
+        embeddings = get_embeddings()
     vectordb = Chroma(
-        persist_directory=str(PERSIST_DIR),
+        persist_directory=str(persist_dir),
         collection_name=COLLECTION_NAME,
         embedding_function=embeddings,
     )
-    logger.info(f"ベクトルDBを読み込みました: {PERSIST_DIR}")
+    logger.info(f"ベクトルDBを読み込みました: {persist_dir}")
     return vectordb
 
 
-def build_rag_chain_with_memory(
-    vectordb: Chroma, 
-    k: int = DEFAULT_TOP_K
-) -> Tuple[RunnableWithMessageHistory, Dict[str, ChatMessageHistory]]:
-    """メモリ付きRAGチェーンを構築
-    
-    Args:
-        vectordb: ベクトルストア
-        k: 検索する文書数
-        
-    Returns:
-        Tuple[チェーン, 会話履歴ストア]
+def build_speaker_filter(vectordb: Chroma) -> Dict[str, str]:
+    """発言者フィルタ（where句）を決める
+
+    speaker_norm 導入前に構築したDBにはこの項目がなく、絞り込むと常に0件になるため、
+    その場合はエラーを記録して speaker の完全一致にフォールバックする。
     """
+    sample = vectordb._collection.get(limit=1, include=["metadatas"])
+    if sample["metadatas"] and "speaker_norm" not in (sample["metadatas"][0] or {}):
+        logger.error(
+            "ベクトルDBに speaker_norm がありません。update_vectorstore で再構築してください"
+            f"（それまでは speaker の完全一致で検索します）: {PERSIST_DIR.resolve()}"
+        )
+        return {"speaker": DEFAULT_SPEAKER}
+    return {"speaker_norm": SPEAKER_NORM}
+
+
+def refresh_vectorstore() -> Chroma:
+    """稼働中スロットが入れ替わっていれば開き直す（判定はリンクの解決のみ）"""
+    global _vectordb, _db_path, _speaker_filter
+    
+    if PERSIST_DIR.resolve() != _db_path:
+        with _reload_lock:
+            active_dir = PERSIST_DIR.resolve()
+            if active_dir != _db_path:
+                vectordb = load_vectorstore(_vectordb.embeddings if _vectordb else None)
+                _speaker_filter = build_speaker_filter(vectordb)
+                _vectordb = vectordb
+                _db_path = active_dir
+    return _vectordb
+
+
+def build_rag_chain() -> Runnable:
+    """履歴なしのRAGチェーン（プロンプト → LLM → 文字列）を構築"""
     prompt = ChatPromptTemplate.from_messages([
         ("system", SYSTEM_PROMPT),
         MessagesPlaceholder(variable_name="chat_history"),
         ("human", "{question}"),
     ])
     
-    llm = ChatOpenAI(model=DEFAULT_MODEL, temperature=DEFAULT_TEMPERATURE)
-    core_chain = prompt | llm | StrOutputParser()
+    llm = ChatOpenAI(
+        model=DEFAULT_MODEL,
+        temperature=DEFAULT_TEMPERATURE,
+        http_client=_openai_http_client,
+    )
+    return prompt | llm | StrOutputParser()
+
+
+def build_rag_chain_with_memory(
+    core_chain: Runnable,
+) -> Tuple[RunnableWithMessageHistory, Optional[Dict[str, ChatMessageHistory]]]:
+    """メモリ付きRAGチェーンを構築
+    
+    REDIS_URL が設定されていれば会話履歴を Redis に保存し、
+    複数ワーカー間・再起動後も履歴を共有する。
+    
+    Args:
+        core_chain: 履歴なしのRAGチェーン
+        
+    Returns:
+        Tuple[チェーン, 会話履歴ストア（Redis利用時はNone）]
+    """
 
     # セッションIDごとに会話履歴を保持
-    store: Dict[str, ChatMessageHistory] = {}
+    store: Optional[Dict[str, ChatMessageHistory]] = None
+
+    if REDIS_URL:
+        def get_session_history(session_id: str) -> BaseChatMessageHistory:
+            return RedisChatMessageHistory(
+                session_id=session_id, url=REDIS_URL, ttl=HISTORY_TTL
+            )
+    else:
+        store = {}
 
-    def get_session_history(session_id: str) -> ChatMessageHistory:
-        if session_id not in store:
-            store[session_id] = ChatMessageHistory()
-        return store[session_id]
+        def get_session_history(session_id: str) -> BaseChatMessageHistory:
+            if session_id not in store:
+                store[session_id] = ChatMessageHistory()
+            return store[session_id]
 
     chain_with_memory = RunnableWithMessageHistory(
         core_chain,
@@ -140,17 +223,46 @@ def diagnose_vectordb() -> None:
         logger.error(traceback.format_exc())
 
 
+def retrieve_docs(question: str, top_k: int) -> List[Document]:
+    """質問を埋め込み、発言者で絞り込んで Chroma コレクションを直接検索
+
+    Chroma の where 句は近傍探索の前に候補を絞り込むため、
+    特定の発言者に絞っても k 件未満になることはない（該当文書が k 件以上ある限り）。
+    """
+    vectordb = refresh_vectorstore()
+    query_vec = vectordb.embeddings.embed_query(question)
+    res = vectordb._collection.query(
+        query_embeddings=[query_vec],
+        n_results=top_k,
+        where=_speaker_filter,
+        include=["documents", "metadatas"],
+    )
+    return [
+        Document(page_content=doc, metadata=meta or {})
+        for doc, meta in zip(res["documents"][0], res["metadatas"][0])
+    ]
+
+
+def get_db_version() -> str:
+    """稼働中のベクトルDBの識別子（スロットのパス）
+
+    スロットは構築ごとに新しく作られるため、パスが変われば内容も変わっている。
+    次の検索では refresh_vectorstore によりこのスロットが読み込まれる。
+    """
+    return str(PERSIST_DIR.resolve())
+
+
 def answer_question(
     question: str,
     top_k: int = DEFAULT_TOP_K,
-    session_id: str = "default",
+    session_id: Optional[str] = "default",
 ) -> Dict:
     """質問に回答するメイン関数
     
     Args:
         question: ユーザーの質問
         top_k: 検索する文書数
-        session_id: セッションID（会話履歴の識別用）
+        session_id: セッションID（会話履歴の識別用）。None の場合は履歴を使わない
         
     Returns:
         Dict: {"answer": 回答, "context_docs": 参照した文書リスト}
@@ -158,52 +270,55 @@ def answer_question(
     Raises:
         RuntimeError: RAGエンジンが初期化されていない場合
     """
-    if _vectordb is None or _chain is None:
+    if _vectordb is None or _chain is None or _core_chain is None:
         raise RuntimeError("RAGエンジンが初期化されていません")
     
     # 発言者でフィルタリング
-    speaker_filter = {"speaker": DEFAULT_SPEAKER}
-    retriever = _vectordb.as_retriever(
-        search_kwargs={"k": top_k, "filter": speaker_filter}
-    )
-    
-    docs = retriever.invoke(question)
-    context_text = format_docs(docs)
+    docs = retrieve_docs(question, top_k)
+    context_text, context_docs = format_and_extract(docs)
     
     logger.info(f"生成されたコンテキストの長さ: {len(context_text)} 文字")
     
-    response = _chain.invoke(
-        {
-            "context": context_text,
-            "question": question,
-        },
-        config={
-            "configurable": {
-                "session_id": session_id,
+    if session_id is None:
+        response = _core_chain.invoke(
+            {
+                "context": context_text,
+                "question": question,
+                "chat_history": [],
             }
-        },
-    )
+        )
+    else:
+        response = _chain.invoke(
+            {
+                "context": context_text,
+                "question": question,
+            },
+            config={
+                "configurable": {
+                    "session_id": session_id,
+                }
+            },
+        )
     
     return {
         "answer": response,
-        "context_docs": [
-            {
-                "content": d.page_content,
-                "source": d.metadata.get("source"),
-            }
-            for d in docs
-        ],
+        "context_docs": context_docs,
     }
 
 
 # ===== モジュール初期化 =====
 _vectordb: Optional[Chroma] = None
+_core_chain: Optional[Runnable] = None
 _chain: Optional[RunnableWithMessageHistory] = None
 _history_store: Optional[Dict[str, ChatMessageHistory]] = None
+_db_path: Optional[Path] = None
+_speaker_filter: Dict[str, str] = {"speaker_norm": SPEAKER_NORM}
+_reload_lock = threading.Lock()
 
 try:
-    _vectordb = load_vectorstore()
-    _chain, _history_store = build_rag_chain_with_memory(_vectordb)
+    refresh_vectorstore()
+    _core_chain = build_rag_chain()
+    _chain, _history_store = build_rag_chain_with_memory(_core_chain)
     logger.info("RAGエンジンの初期化が完了しました")
 except Exception as e:
     logger.error(f"RAGエンジンの初期化に失敗しました: {e}")
@@ -1,45 +1,88 @@
 # src/update_vectorstore.py
 """JSONLデータからChromaベクトルDBを構築・更新するスクリプト"""
 
+import re
 import shutil
-import json
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Iterable, List, Dict, Any
+from typing import Iterable, List, Dict, Any, Optional
 
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+import chromadb
+import numpy as np
+import orjson
+import xxhash
+
+from langchain_text_splitters import TextSplitter
 from langchain_core.documents import Document
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_chroma import Chroma
+
+from src.utils import (
+    COLLECTION_NAME,
+    DB_ROOT,
+    PERSIST_DIR,
+    SLOT_PREFIX,
+    get_embeddings,
+    migrate_legacy_db,
+    new_slot_dir,
+    normalize_speaker,
+    point_active_db,
+    symlinks_supported,
+)
 
 # ===== パス設定 =====
 BASE_DIR = Path(__file__).resolve().parent.parent
 DATA_PATH = BASE_DIR / "data" / "diet_speeches.jsonl"
-ACTIVE_DB_DIR = BASE_DIR / "chroma_db"
-TEMP_DB_DIR = BASE_DIR / "chroma_db_temp"
+ACTIVE_DB_DIR = PERSIST_DIR
+TEMP_DB_DIR = DB_ROOT / "temp"  # シンボリックリンク非対応環境用
 
 # ===== モデル・処理設定 =====
-EMBED_MODEL = "intfloat/multilingual-e5-small"
-COLLECTION_NAME = "kokkai_diet_all"
 MAX_LEN_NO_SPLIT = 1200
 CHUNK_SIZE = 1200
 CHUNK_OVERLAP = 200
-BATCH_SIZE = 200
+BATCH_SIZE = 2048
+ENCODE_BATCH_SIZE = 128
 
 # ===== テキストスプリッター =====
-splitter = RecursiveCharacterTextSplitter(
+SENTENCE_SPLIT = re.compile(r"(?<=[\n。])")  # 改行・句点の直後で分割（区切りは残す）
+CLAUSE_SPLIT = re.compile(r"(?<=[、 ])")  # 長すぎる文のみ読点・空白で分割
+
+
+class SentenceTextSplitter(TextSplitter):
+    """文単位に1回の正規表現走査で分割し、チャンクサイズまで貪欲に詰めるスプリッター
+
+    区切り文字ごとに再帰分割する RecursiveCharacterTextSplitter の代わりに使う。
+    結合（オーバーラップ含む）は TextSplitter._merge_splits に任せる。
+    """
+
+    def split_text(self, text: str) -> List[str]:
+        pieces: List[str] = []
+        for sentence in SENTENCE_SPLIT.split(text):
+            if len(sentence) <= self._chunk_size:
+                if sentence:
+                    pieces.append(sentence)
+                continue
+            for clause in CLAUSE_SPLIT.split(sentence):
+                # 区切りのない長い句は固定長で切る
+                pieces.extend(
+                    clause[i:i + self._chunk_size]
+                    for i in range(0, len(clause), self._chunk_size)
+                )
+        return self._merge_splits(pieces, "")
+
+
+splitter = SentenceTextSplitter(
     chunk_size=CHUNK_SIZE,
     chunk_overlap=CHUNK_OVERLAP,
-    separators=["\n\n", "\n", "。", "、", " "],
 )
 
 
 def iter_speech_records(jsonl_path: Path) -> Iterable[Dict[str, Any]]:
     """JSONLファイルからレコードを1件ずつ読み込む（ジェネレータ）"""
-    with jsonl_path.open("r", encoding="utf-8") as f:
+    with jsonl_path.open("rb") as f:
         for line in f:
             line = line.strip()
             if line:
-                yield json.loads(line)
+                yield orjson.loads(line)
 
 
 def build_base_text(rec: Dict[str, Any]) -> str:
@@ -62,6 +105,7 @@ def build_metadata(rec: Dict[str, Any], rec_idx: int) -> Dict[str, Any]:
         "nameOfHouse": rec.get("nameOfHouse"),
         "nameOfMeeting": rec.get("nameOfMeeting"),
         "speaker": rec.get("speaker"),
+        "speaker_norm": normalize_speaker(rec.get("speaker") or ""),
         "speakerGroup": rec.get("speakerGroup"),
         "speechURL": rec.get("speechURL"),
         "meetingURL": rec.get("meetingURL"),
@@ -94,49 +138,107 @@ def build_documents(jsonl_path: Path) -> Iterable[Document]:
             )
 
 
+def iter_batches(docs: Iterable[Document], size: int) -> Iterable[List[Document]]:
+    """Documentを size 件ずつのバッチにまとめる"""
+    batch: List[Document] = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 def build_vectorstore(persist_dir: Path) -> None:
-    """ベクトルDBを構築"""
-    # 既存のDBを削除
-    if persist_dir.exists():
+    """ベクトルDBを構築
+
+    バッチN+1の埋め込み計算と、バッチNのChromaへの書き込みを並行して行う。
+    同一テキストのチャンクはハッシュで判定し、埋め込みを再利用する。
+    """
+    # 既存のDBを削除（新規作成した空のスロットはそのまま使う）
+    if persist_dir.exists() and any(persist_dir.iterdir()):
         print(f"[build] Delete the existing working DB: {persist_dir}")
         shutil.rmtree(persist_dir)
 
     print("[build] Loading embedding model...")
-    embeddings = HuggingFaceEmbeddings(model_name=EMBED_MODEL)
+    embeddings = get_embeddings(batch_size=ENCODE_BATCH_SIZE)
 
     print(f"[build] Creating an empty Chroma collection: {persist_dir}")
-    vectorstore = Chroma(
-        collection_name=COLLECTION_NAME,
-        persist_directory=str(persist_dir),
-        embedding_function=embeddings,
-    )
+    client = chromadb.PersistentClient(path=str(persist_dir))
+    collection = client.get_or_create_collection(COLLECTION_NAME)
 
     print("[build] Document → Chroma adding...")
-    batch: List[Document] = []
     total = 0
-
-    for doc in build_documents(DATA_PATH):
-        batch.append(doc)
-        
-        if len(batch) >= BATCH_SIZE:
-            vectorstore.add_documents(batch)
+    reused = 0
+    pending: Optional[Future] = None
+    seen: Dict[int, np.ndarray] = {}  # テキストのハッシュ → 埋め込み
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        for batch in iter_batches(build_documents(DATA_PATH), BATCH_SIZE):
+            texts = [d.page_content for d in batch]
+            hashes = [xxhash.xxh3_64_intdigest(t) for t in texts]
+
+            # 未出現のテキストだけ埋め込む（バッチ内の重複も1回にまとめる）
+            new_texts: Dict[int, str] = {}
+            for h, t in zip(hashes, texts):
+                if h not in seen and h not in new_texts:
+                    new_texts[h] = t
+            if new_texts:
+                new_vectors = embeddings.embed_documents(list(new_texts.values()))
+                for h, v in zip(new_texts, new_vectors):
+                    seen[h] = np.asarray(v, dtype=np.float32)
+            reused += len(texts) - len(new_texts)
+            vectors = np.stack([seen[h] for h in hashes])
+
+            # 前バッチの書き込み完了を待ってから次を投入
+            if pending is not None:
+                pending.result()
+            pending = executor.submit(
+                collection.add,
+                ids=[str(uuid.uuid4()) for _ in batch],
+                embeddings=vectors,
+                documents=texts,
+                metadatas=[d.metadata for d in batch],
+            )
             total += len(batch)
-            print(f"\r[build] Added: {total} docs", end="", flush=True)
-            batch = []
+            print(f"\r[build] Added: {total} docs (reused: {reused})", end="", flush=True)
 
-    # 残りのバッチを処理
-    if batch:
-        vectorstore.add_documents(batch)
-        total += len(batch)
-        print(f"\r[build] Added: {total} docs", end="", flush=True)
+        if pending is not None:
+            pending.result()
 
     print("\n[build] Vector DB construction completed (auto-persisted)")
 
 
+def prune_slots(keep: Iterable[Path]) -> None:
+    """keep 以外の古いスロットを削除
+
+    直前まで稼働していたスロットは keep に含めて残す（読み込み中のプロセスがあるため）。
+    APIプロセスは次のリクエスト時に新スロットへ開き直すので、次回の構築時に削除される。
+    """
+    keep_names = {p.name for p in keep}
+    for slot in DB_ROOT.glob(f"{SLOT_PREFIX}*"):
+        if slot.is_dir() and slot.name not in keep_names:
+            print(f"[swap] Delete the old DB slot: {slot}")
+            shutil.rmtree(slot)
+
+
 def swap_active_db(temp_dir: Path, active_dir: Path) -> None:
-    """作業用DBを本番用DBに昇格（マウントされたディレクトリ対応）"""
+    """作業用DBを本番用DBに昇格（シンボリックリンクのアトミックな付け替え）"""
     print(f"[swap] Promoting working DB to production DB: {temp_dir} -> {active_dir}")
-    
+
+    if not symlinks_supported(active_dir.parent):
+        move_contents(temp_dir, active_dir)
+        return
+
+    # 新しいリンクを作成し、rename で1回のシステムコールで差し替える
+    point_active_db(temp_dir)
+
+    print("[swap] Swap completed successfully")
+
+
+def move_contents(temp_dir: Path, active_dir: Path) -> None:
+    """作業用DBの中身を本番用DBへ移動（シンボリックリンク非対応環境用）"""
     # active_dir の中身だけを削除（ディレクトリ自体は残す）
     if active_dir.exists():
         print(f"[swap] Clearing contents of: {active_dir}")
@@ -164,15 +266,29 @@ def main() -> None:
     if not DATA_PATH.exists():
         raise FileNotFoundError(f"JSONL not found: {DATA_PATH}")
 
+    DB_ROOT.mkdir(parents=True, exist_ok=True)
+    migrate_legacy_db()
+    use_symlink = symlinks_supported(DB_ROOT)
+    if use_symlink:
+        # 稼働中・直前のスロットには触れず、毎回新しいスロットへ構築する
+        previous_dir = ACTIVE_DB_DIR.resolve() if ACTIVE_DB_DIR.is_symlink() else None
+        work_dir = new_slot_dir()
+    else:
+        work_dir = TEMP_DB_DIR
+
     print(f"[main] JSONL: {DATA_PATH.resolve()}")
     print(f"[main] Active DB: {ACTIVE_DB_DIR.resolve()}")
-    print(f"[main] Temporary DB: {TEMP_DB_DIR.resolve()}")
+    print(f"[main] Working DB: {work_dir.resolve()}")
 
-    # 1. 一時DBを構築
-    build_vectorstore(TEMP_DB_DIR)
+    # 1. 作業用DB（非稼働スロット）を構築
+    build_vectorstore(work_dir)
 
     # 2. 本番DBと入れ替え
-    swap_active_db(TEMP_DB_DIR, ACTIVE_DB_DIR)
+    swap_active_db(work_dir, ACTIVE_DB_DIR)
+
+    # 3. どのプロセスも参照していない古いスロットを削除
+    if use_symlink:
+        prune_slots([work_dir] + ([previous_dir] if previous_dir else []))
 
 
 if __name__ == "__main__":
@@ -1,32 +1,280 @@
 # src/utils.py
 """共通ユーティリティ：パス設定、埋め込みモデル、ヘルパー関数"""
 
+import logging
 import os
+import re
+import shutil
+import tempfile
+import time
+import unicodedata
 from pathlib import Path
-from typing import List
+from typing import Any, Dict, List, Optional, Tuple
 
+import numpy as np
+import torch
 from dotenv import load_dotenv
+from langchain_classic.embeddings import CacheBackedEmbeddings
+from langchain_classic.storage import LocalFileStore
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 
 # ===== パス設定 =====
 BASE_DIR = Path(__file__).resolve().parent.parent
 DATA_DIR = BASE_DIR / "data"
-PERSIST_DIR = BASE_DIR / "chroma_db"
+DB_ROOT = BASE_DIR / "chroma_db"
+PERSIST_DIR = DB_ROOT / "current"  # 稼働中のスロットを指すシンボリックリンク
+SLOT_PREFIX = "slot_"  # 構築ごとに作る DB_ROOT/slot_<作成時刻>_<乱数> の接頭辞
+LEGACY_SLOT = DB_ROOT / f"{SLOT_PREFIX}legacy"  # 旧レイアウトからの移行先
+ONNX_MODEL_DIR = BASE_DIR / "onnx_models" / "multilingual-e5-small-int8"
+EMBED_CACHE_DIR = BASE_DIR / ".embed_cache"
 
 # ===== モデル設定 =====
 COLLECTION_NAME = "kokkai_diet_all"
 EMBED_MODEL = "intfloat/multilingual-e5-small"
+EMBED_DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+EMBED_MAX_LENGTH = 512
+DEFAULT_ENCODE_BATCH_SIZE = 32
 
 # ===== 環境変数読み込み =====
 load_dotenv(BASE_DIR / ".env")
 
+# 埋め込みの実行バックエンド（"onnx": ONNX Runtime int8 / "torch": PyTorch FP32）
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "onnx")
+# torch バックエンドで torch.compile を使うか（inductor に C コンパイラが必要なため既定は無効）
+EMBED_TORCH_COMPILE = os.getenv("EMBED_TORCH_COMPILE", "0") == "1"
 
-def get_embeddings() -> HuggingFaceEmbeddings:
-    """共通の埋め込みモデルを返す"""
-    return HuggingFaceEmbeddings(model_name=EMBED_MODEL)
+logger = logging.getLogger(__name__)
 
 
-def format_docs(docs: List[Document]) -> str:
-    """Documentリストを1つの文字列に連結"""
-    return "\n\n".join(d.page_content for d in docs)
\ No newline at end of file
+def symlinks_supported(root: Path) -> bool:
+    """root 配下にシンボリックリンクを作成できるか判定（Windows等では不可の場合あり）"""
+    probe = root / ".symlink_probe"
+    try:
+        if probe.is_symlink():
+            probe.unlink()
+        probe.symlink_to(".", target_is_directory=True)
+        probe.unlink()
+        return True
+    except (OSError, NotImplementedError):
+        return False
+
+
+def new_slot_dir() -> Path:
+    """新しいスロット用ディレクトリを作成して返す（名前は作成時刻順に並ぶ）"""
+    DB_ROOT.mkdir(parents=True, exist_ok=True)
+    prefix = f"{SLOT_PREFIX}{time.strftime('%Y%m%d%H%M%S')}_"
+    slot = Path(tempfile.mkdtemp(prefix=prefix, dir=DB_ROOT))
+    slot.chmod(0o755)  # mkdtemp は 0700 で作るため、別ユーザーのAPIコンテナからも読めるようにする
+    return slot
+
+
+def point_active_db(slot: Path) -> None:
+    """PERSIST_DIR のリンク先を slot に差し替える（rename による1回のアトミック操作）"""
+    tmp_link = PERSIST_DIR.with_name(PERSIST_DIR.name + ".new")
+    if tmp_link.is_symlink() or tmp_link.exists():
+        tmp_link.unlink()
+    tmp_link.symlink_to(slot.name, target_is_directory=True)
+    os.replace(tmp_link, PERSIST_DIR)
+
+
+def migrate_legacy_db(stale_after: float = 60.0) -> None:
+    """旧レイアウト（chroma_db 直下にDB本体）をスロット構成へ移行
+
+    DB本体を固定名のスロットに移動して PERSIST_DIR をそこへ向ける。
+    複数プロセスが同時に呼んでも、ロック用ディレクトリを作れた1プロセスだけが移行する。
+    移行は途中で中断しても再実行で続きから完了できるため、
+    stale_after 秒より古いロックは中断したプロセスの残骸とみなして引き継ぐ。
+    """
+    if PERSIST_DIR.exists() or not (DB_ROOT / "chroma.sqlite3").exists():
+        return
+
+    lock_dir = DB_ROOT / ".migrating"
+    while True:
+        try:
+            lock_dir.mkdir()
+            break
+        except FileExistsError:
+            pass
+        # 他プロセスが移行中なら完了を待つ
+        if PERSIST_DIR.exists():
+            return
+        try:
+            lock_age = time.time() - lock_dir.stat().st_mtime
+        except FileNotFoundError:
+            continue  # ちょうど解放された
+        if lock_age > stale_after:
+            logger.warning(f"古い移行ロックを削除して移行を再開します: {lock_dir}")
+            shutil.rmtree(lock_dir, ignore_errors=True)
+            continue
+        time.sleep(0.1)
+
+    try:
+        if PERSIST_DIR.exists():
+            return
+        # PERSIST_DIR は移動が全て終わってから作る（存在すれば移行完了とみなせる）
+        reserved = {PERSIST_DIR.name, PERSIST_DIR.name + ".new", lock_dir.name, "temp"}
+        LEGACY_SLOT.mkdir(exist_ok=True)
+        for item in DB_ROOT.iterdir():
+            if item.name not in reserved and not item.name.startswith(SLOT_PREFIX):
+                try:
+                    shutil.move(str(item), str(LEGACY_SLOT / item.name))
+                except FileNotFoundError:
+                    pass  # ロックを引き継いだ側が移動済み
+        if symlinks_supported(DB_ROOT):
+            point_active_db(LEGACY_SLOT)
+        else:
+            LEGACY_SLOT.rename(PERSIST_DIR)
+    finally:
+        shutil.rmtree(lock_dir, ignore_errors=True)
+
+
+def export_onnx_model(model_dir: Path = ONNX_MODEL_DIR) -> None:
+    """埋め込みモデルをONNXへ変換し、int8動的量子化して保存
+
+    一時ディレクトリに書き出してから rename で配置するため、
+    複数プロセスが同時に実行しても書きかけのモデルは見えない。
+    """
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+
+    model_dir.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dir = Path(tempfile.mkdtemp(prefix=".export-", dir=model_dir.parent))
+    try:
+        model = ORTModelForFeatureExtraction.from_pretrained(EMBED_MODEL, export=True)
+        quantizer = ORTQuantizer.from_pretrained(model)
+        qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+        quantizer.quantize(save_dir=tmp_dir, quantization_config=qconfig)
+        AutoTokenizer.from_pretrained(EMBED_MODEL).save_pretrained(tmp_dir)
+        try:
+            os.replace(tmp_dir, model_dir)
+        except OSError:
+            pass  # 他のプロセスが先に配置済み
+    finally:
+        if tmp_dir.exists():
+            shutil.rmtree(tmp_dir)
+
+
+def compile_embeddings(embeddings: HuggingFaceEmbeddings) -> HuggingFaceEmbeddings:
+    """内部の Transformer を torch.compile でカーネル融合する（失敗時は通常実行）"""
+    if not hasattr(torch, "compile"):
+        return embeddings
+
+    transformer = embeddings._client[0]
+    eager_model = transformer.auto_model
+    try:
+        transformer.auto_model = torch.compile(eager_model, dynamic=True)
+        embeddings.embed_query("warmup")  # コンパイルは初回呼び出し時に走る
+    except Exception as e:
+        logger.warning(f"torch.compile に失敗したため通常実行に戻します: {e}")
+        transformer.auto_model = eager_model
+    return embeddings
+
+
+class ONNXEmbeddings(Embeddings):
+    """ONNX Runtime（int8量子化）で推論する埋め込みモデル
+
+    モデルは事前に `python -m src.utils` でエクスポートしておく（未作成なら初回に作成）。
+    取り込み側とクエリ側で同じファイルを読むこと（量子化結果は環境により異なりうる）。
+    プーリングは sentence-transformers と同じ平均プーリング + L2正規化。
+    """
+
+    def __init__(
+        self,
+        model_dir: Path = ONNX_MODEL_DIR,
+        batch_size: int = DEFAULT_ENCODE_BATCH_SIZE,
+    ) -> None:
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+
+        if not (model_dir / "model_quantized.onnx").exists():
+            export_onnx_model(model_dir)
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        model = ORTModelForFeatureExtraction.from_pretrained(
+            model_dir, file_name="model_quantized.onnx"
+        )
+        self.session = model.session
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        self.batch_size = batch_size
+
+    def _encode(self, texts: List[str]) -> List[List[float]]:
+        vectors: List[List[float]] = []
+        for start in range(0, len(texts), self.batch_size):
+            enc = self.tokenizer(
+                texts[start:start + self.batch_size],
+                padding=True,
+                truncation=True,
+                max_length=EMBED_MAX_LENGTH,
+                return_tensors="np",
+            )
+            # XLM-R トークナイザーは token_type_ids を返さないため 0 で補う
+            feed = {
+                name: enc[name].astype(np.int64) if name in enc
+                else np.zeros_like(enc["input_ids"], dtype=np.int64)
+                for name in self.input_names
+            }
+            hidden = self.session.run(None, feed)[0]
+
+            # 平均プーリング（パディングを除外）→ L2正規化
+            mask = enc["attention_mask"][..., None].astype(hidden.dtype)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            pooled /= np.linalg.norm(pooled, axis=1, keepdims=True)
+            vectors.extend(pooled.tolist())
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._encode(list(texts))
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._encode([text])[0]
+
+
+def get_embeddings(batch_size: int = DEFAULT_ENCODE_BATCH_SIZE) -> Embeddings:
+    """共通の埋め込みモデルを返す（文書・クエリともにローカルキャッシュ付き）"""
+    if EMBED_BACKEND == "onnx":
+        underlying: Embeddings = ONNXEmbeddings(batch_size=batch_size)
+    else:
+        # attention は PyTorch の SDPA（fused kernel）で実行
+        underlying = HuggingFaceEmbeddings(
+            model_name=EMBED_MODEL,
+            model_kwargs={
+                "device": EMBED_DEVICE,
+                "model_kwargs": {"attn_implementation": "sdpa"},
+            },
+            encode_kwargs={"batch_size": batch_size, "normalize_embeddings": True},
+        )
+        if EMBED_TORCH_COMPILE:
+            underlying = compile_embeddings(underlying)
+
+    # バックエンドごとにベクトルが異なるため名前空間を分ける
+    # （LocalFileStore のキーは英数字と _ . - / のみ使用可）
+    return CacheBackedEmbeddings.from_bytes_store(
+        underlying,
+        LocalFileStore(str(EMBED_CACHE_DIR)),
+        namespace=f"{EMBED_MODEL}/{EMBED_BACKEND}/",
+        query_embedding_cache=True,
+        key_encoder="blake2b",
+    )
+
+
+def format_and_extract(docs: List[Document]) -> Tuple[str, List[Dict[str, Any]]]:
+    """Documentリストを1回の走査で連結テキストと参照文書リストに変換"""
+    parts: List[Optional[str]] = [None] * len(docs)
+    context_docs: List[Optional[Dict[str, Any]]] = [None] * len(docs)
+    for i, d in enumerate(docs):
+        parts[i] = d.page_content
+        context_docs[i] = {"content": d.page_content, "source": d.metadata.get("source")}
+    return "\n\n".join(parts), context_docs
+
+
+def normalize_speaker(name: str) -> str:
+    """発言者名を正規化（NFKC + 空白除去）してメタデータの完全一致フィルタに使う"""
+    return re.sub(r"\s+", "", unicodedata.normalize("NFKC", name))
+
+
+if __name__ == "__main__":
+    # ONNXモデルの事前エクスポート（Dockerビルド時などに実行）
+    export_onnx_model()